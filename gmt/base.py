@@ -1,6 +1,7 @@
 from math import ceil, sqrt
 from re import sub
 import gmt.private as gp
+from gmt.private import proc_flag
 
 _gmt = gp.GMT()
 
@@ -8,7 +9,7 @@ _current_module = __import__(__name__)
 
 
 for cmd in gp.gmt_commands:
-    setattr(_current_module, cmd, gp.make_cmd(cmd))
+    setattr(_current_module, cmd, gp.make_cmd(cmd, _gmt))
 
     
 def out(outfile):
@@ -259,18 +260,6 @@ def get_paper_size(paper, is_portrait=False):
     
     return width, height
 
-    
-def proc_flag(flag):
-    """ Parse GMT flags. """
-    if isinstance(flag, bool) and flag:
-        return ""
-    elif hasattr(flag, "__iter__") and not isinstance(flag, string_types):
-        return "/".join(str(elem) for elem in flag)
-    elif flag is None:
-        return ""
-    else:
-        return flag
-
 
 dem_dtypes = {
     "r4":"f"
@@ -1,13 +1,20 @@
 import os
+import sys
+import json
 import os.path as pth
 import subprocess as subp
 from shlex import split
+from shutil import which
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait
 from distutils.version import StrictVersion
 from argparse import ArgumentParser
 # python 2/3 compatibility
 from six import string_types
 
-def cmd(Cmd):
+from gmt.session import library
+
+def cmd(Cmd, ret=True):
     """
     Execute terminal command defined by `cmd`, optionally return the
     output of the executed command if `ret` is set to True.
@@ -21,8 +28,9 @@ def cmd(Cmd):
         
         raise e
         
-    return " ".join(elem for elem in cmd_out.decode().split("\n")
-                    if not elem.startswith("gmt:"))
+    if ret:
+        return " ".join(elem for elem in cmd_out.decode().split("\n")
+                        if not elem.startswith("gmt:"))
 
 
 def gmt(module, *args, **kwargs):
@@ -42,9 +50,68 @@ def gmt(module, *args, **kwargs):
     return cmd(Cmd)
 
 
+# on-disk cache of the detected GMT versions, set it to None to disable it
+version_cache = pth.join(os.environ.get("XDG_CACHE_HOME",
+                                        pth.join(pth.expanduser("~"), ".cache")),
+                         "gmt_versions.json")
+
+_version, _version_lock = None, Lock()
+
+
 def get_version():
-    """ Get the version of the installed GMT as a Strict Version object. """
-    return StrictVersion(cmd("gmt --version", ret=True).strip())
+    """
+    Get the version of the installed GMT as a Strict Version object. GMT
+    is only asked once per process, see `probe_version`.
+    """
+    global _version
+    
+    with _version_lock:
+        if _version is None:
+            _version = StrictVersion(probe_version())
+    
+    return _version
+
+
+def probe_version(exe="gmt"):
+    """
+    Returns the version string of GMT executable `exe`. Results are kept
+    in `version_cache` keyed by the resolved path and modification time of
+    the executable, so reinstalling GMT invalidates them.
+    """
+    path = which(exe)
+    
+    if path is None or version_cache is None:
+        return cmd("%s --version" % exe).strip()
+    
+    path = pth.realpath(path)
+    key = "%s:%s" % (path, os.stat(path).st_mtime)
+    
+    try:
+        with open(version_cache) as f:
+            versions = json.load(f)
+    except (OSError, ValueError):
+        versions = {}
+    
+    if key in versions:
+        return versions[key]
+    
+    version = versions[key] = cmd("%s --version" % path).strip()
+    
+    # a failed write only means GMT is asked again next time
+    try:
+        os.makedirs(pth.dirname(version_cache), exist_ok=True)
+        
+        tmp = "%s.%d" % (version_cache, os.getpid())
+        
+        with open(tmp, "w") as f:
+            json.dump(versions, f)
+        
+        os.replace(tmp, version_cache)
+    except OSError:
+        pass
+    
+    return version
+
 
 class GMT(object):
     def __init__(self):
@@ -94,6 +161,16 @@ class GMT(object):
         self.commands = []
         self.debug = False
         
+        # number of gmt commands executed in parallel by finalize
+        self.workers = os.cpu_count()
+        
+        # "library" runs the modules through the GMT C API in this process
+        # (if libgmt is available), "subprocess" starts gmt for each one;
+        # the library modules write to file descriptor 1, which is
+        # redirected to their output files for the whole process while
+        # they run, so other threads must not print to stdout meanwhile
+        self.backend = "subprocess"
+        
 
 
     def __getitem__(self, key):
@@ -104,7 +181,7 @@ class GMT(object):
         commands = self.commands
         
         # indices of plotter functions
-        idx = tuple(ii for ii, Cmd in enumerate(commands) if Cmd[0] in _plotters)
+        idx = tuple(ii for ii, Cmd in enumerate(commands) if Cmd[0] in plotters)
         
         # add -K, -P and -O flags to plotter functions
         if len(idx) > 1:
@@ -119,8 +196,8 @@ class GMT(object):
                 commands[ii][1] += " -P"
         
         if self.is_gmt5:
-            commands = (("gmt " + Cmd[0], Cmd[1], Cmd[2], Cmd[3])
-                        for Cmd in commands)
+            commands = [("gmt " + Cmd[0], Cmd[1], Cmd[2], Cmd[3])
+                        for Cmd in commands]
         
         # print commands for debugging
         if self.debug:
@@ -134,9 +211,20 @@ class GMT(object):
         for out in outfiles:
             os.remove(out)
         
-        # execute gmt commands and write their output to the specified files
-        for Cmd in commands:
-            _execute_gmt_cmd(Cmd)
+        # execute gmt commands and write their output to the specified
+        # files, independent commands are run in parallel
+        # a new library session reads the gmt.conf written for this run
+        session = library() if self.backend == "library" else None
+        outputs = _Outputs()
+        
+        try:
+            _execute_gmt_cmds(tuple(commands), self.workers, session,
+                              outputs)
+        finally:
+            outputs.close()
+            
+            if session is not None:
+                session.close()
         
         # Cleanup
         if pth.isfile("gmt.history"):
@@ -150,16 +238,219 @@ class GMT(object):
             self.finalize()
 
 
-def _execute_gmt_cmd(Cmd, ret_out=False):
+class _Outputs(object):
+    """
+    Output files of the gmt commands, every file is opened only once (in
+    append mode) and shared by all the commands writing to it.
+    """
+    def __init__(self):
+        self.files, self.lock = {}, Lock()
+    
+    def __call__(self, path):
+        if path is None:
+            return None
+        
+        with self.lock:
+            f = self.files.get(path)
+            
+            if f is None:
+                f = self.files[path] = open(path, "ab")
+        
+        return f
+    
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        
+        self.files = {}
+
+
+def _execute_gmt_cmd(Cmd, ret_out=False, session=None, outputs=None):
+    if outputs is None:
+        outputs = _Outputs()
+        
+        try:
+            return _execute_gmt_cmd(Cmd, ret_out, session, outputs)
+        finally:
+            outputs.close()
+    
+    out = outputs(Cmd[3])
+    
+    # input data is written to the standard input of a gmt process
+    if session is not None and Cmd[2] is None:
+        words = Cmd[0].split()
+        module = _module_name(Cmd)
+        
+        # arguments may be part of the command, e.g. "gmt set KEY=VALUE"
+        args = words[words.index(module) + 1:]
+        
+        if Cmd[1] is not None:
+            args.append(Cmd[1])
+        
+        session.call(module, " ".join(args), out)
+        return
+    
     # join command and flags
-    cmd_out = cmd("{} {}".format(Cmd[0], Cmd[1]))
+    Cmd_ = "{} {}".format(Cmd[0], Cmd[1] or "")
+    
+    # the output goes straight into the file, only the messages on the
+    # standard error are read here
+    stdout = subp.DEVNULL if out is None else out
+    stdin = None if Cmd[2] is None else subp.PIPE
+    proc = subp.Popen(split(Cmd_), stdin=stdin, stdout=stdout,
+                      stderr=subp.PIPE)
+    
+    _, err = proc.communicate(Cmd[2])
+    
+    messages = "\n".join(line for line in err.decode().split("\n")
+                         if line and not line.startswith("gmt:"))
+    
+    if proc.returncode != 0:
+        print("ERROR: Non zero returncode from command: '{}'".format(Cmd_))
+        print("OUTPUT OF THE COMMAND: \n{}".format(messages))
+        print("RETURNCODE was: {}".format(proc.returncode))
         
+        raise subp.CalledProcessError(proc.returncode, Cmd_, err)
+    
+    if messages:
+        sys.stderr.write("%s\n" % messages)
+
+
+def _module_name(Cmd):
+    words = Cmd[0].split()
+    return words[1] if words[0] == "gmt" and len(words) > 1 else words[0]
+
+
+def _files(Cmd):
+    """
+    Files read and written by gmt command `Cmd`. Every argument that looks
+    like a path (optionally following a flag, e.g. -Cfile.cpt) is
+    considered to be read. Explicit -R and -J options are saved to
+    gmt.history, bare ones are read back from it.
+    """
+    module, tokens = _module_name(Cmd), split(Cmd[1] or "")
+    
+    reads, writes = set(), set()
+    
     if Cmd[3] is not None:
-        with open(Cmd[3], "a") as f:
-            f.write(cmd_out)
+        writes.add(Cmd[3])
+    
+    for ii, token in enumerate(tokens):
+        if token == "=" and ii + 1 < len(tokens):
+            # grdmath ... = outfile
+            writes.add(tokens[ii + 1])
+        elif token.startswith("-G") and module not in plotters:
+            # output grid of grd* modules, fill color of plotters
+            writes.add(token[2:])
+        elif token in ("-R", "-J"):
+            reads.add("gmt.history")
+        elif token.startswith(("-R", "-J")):
+            writes.add("gmt.history")
+            reads.add(token[2:])
+        elif token.startswith("-"):
+            reads.add(token[2:])
+        else:
+            reads.add(token)
+    
+    # flags without arguments
+    reads.discard("")
+    
+    return reads - writes, writes
+
+
+# modules writing gmt.conf, every later command depends on them
+setters = frozenset({"set", "gmtset"})
+
+
+def _dependencies(commands):
+    """
+    Indices of the commands every command of `commands` has to wait for:
+    earlier commands writing a file it reads or writes, or reading a file
+    it writes. The order of the plotters appending to the same PostScript
+    file is kept this way as well. gmt set (gmtset) commands act as
+    barriers.
+    """
+    files = tuple(_files(Cmd) for Cmd in commands)
+    deps, barrier = [], None
+    
+    for ii, Cmd in enumerate(commands):
+        if _module_name(Cmd) in setters:
+            deps.append(tuple(range(ii)))
+            barrier = ii
+            continue
+        
+        reads, writes = files[ii]
+        start = 0 if barrier is None else barrier + 1
+        
+        dep = tuple(jj for jj in range(start, ii)
+                    if files[jj][1] & (reads | writes)
+                    or files[jj][0] & writes)
+        
+        deps.append(dep if barrier is None else (barrier,) + dep)
+    
+    return deps
+
+
+def _execute_gmt_cmds(commands, workers=None, session=None,
+                      outputs=None):
+    """
+    Executes `commands`, running the ones that do not depend on each
+    other in parallel on `workers` threads. Library `session` executes
+    one module at a time, so they are run in order in that case.
+    """
+    if session is not None or (workers is not None and workers < 2):
+        for Cmd in commands:
+            if session is not None and _module_name(Cmd) in setters:
+                # a library session reads gmt.conf only when it is
+                # created: the executable writes the new defaults, the
+                # modules after it run in a new session
+                _execute_gmt_cmd(Cmd, outputs=outputs)
+                session.reopen()
+            else:
+                _execute_gmt_cmd(Cmd, session=session, outputs=outputs)
+        
+        return
+    
+    futures = []
+    
+    def run(Cmd, dep):
+        # dependencies were submitted earlier so they are already running
+        # or done, waiting for them cannot deadlock the pool
+        for future in dep:
+            future.result()
+        
+        _execute_gmt_cmd(Cmd, outputs=outputs)
+    
+    with ThreadPoolExecutor(workers) as executor:
+        for Cmd, dep in zip(commands, _dependencies(commands)):
+            futures.append(executor.submit(run, Cmd,
+                                           tuple(futures[jj] for jj in dep)))
+        
+        wait(futures)
     
+    # re-raise the first error
+    for future in futures:
+        future.result()
+
 
-def make_cmd(gmt_exec):
+def proc_flag(flag):
+    """ Parse GMT flags. """
+    if isinstance(flag, bool) and flag:
+        return ""
+    elif hasattr(flag, "__iter__") and not isinstance(flag, string_types):
+        return "/".join(str(elem) for elem in flag)
+    elif flag is None:
+        return ""
+    else:
+        return flag
+
+
+def make_cmd(gmt_exec, _gmt):
+    """
+    Returns a function queueing gmt module `gmt_exec` to the commands of
+    `GMT` instance `_gmt`. Its `data` can be a path, a list of lines or a
+    numpy array, which is streamed to the module in binary format.
+    """
     def f(data=None, byte_swap=False, outfile=None, **flags):
         if data is not None:
             if isinstance(data, string_types) and pth.isfile(data):
@@ -169,6 +460,10 @@ def make_cmd(gmt_exec):
             elif isinstance(data, list) or isinstance(data, tuple):
                 data = ("\n".join(elem for elem in data)).encode()
                 gmt_flags = ""
+            elif hasattr(data, "dtype"):
+                # numpy array, streamed to the module in binary format
+                gmt_flags, data = binary_input(data)
+                gmt_flags += " "
             else:
                 raise ValueError("`data` should be a path to an existing file!")
         else:
@@ -180,18 +475,81 @@ def make_cmd(gmt_exec):
                                    for key, flag in flags.items()))
         
         # if we have common flags add them
-        if self.common is not None:
-            gmt_flags += " " + self.common
+        if _gmt.common is not None:
+            gmt_flags += " " + _gmt.common
         
         if outfile is not None:
             _gmt.commands.append([gmt_exec, gmt_flags, data, outfile])
         else:
-            _gmt.commands.append([gmt_exec, gmt_flags, data, self.out])
+            _gmt.commands.append([gmt_exec, gmt_flags, data, _gmt.out])
     #end f
     
     return f
 
 
+# GMT binary column type codes of numpy kinds and item sizes
+binary_codes = {
+    "i1": "c", "u1": "u",
+    "i2": "h", "u2": "H",
+    "i4": "i", "u4": "I",
+    "i8": "l", "u8": "L",
+    "f4": "f", "f8": "d",
+}
+
+
+def binary_code(dtype):
+    try:
+        return binary_codes["%s%d" % (dtype.kind, dtype.itemsize)]
+    except KeyError:
+        raise ValueError("Data type '{}' cannot be passed to GMT."
+                         .format(dtype))
+
+
+def binary_input(data):
+    """
+    Returns the -bi flag describing numpy array `data` and the bytes of
+    the array in that layout. Rows of 2D arrays and records of structured
+    arrays are the input records, their columns or fields the columns.
+    """
+    import numpy as np
+    
+    data = np.asarray(data)
+    
+    if data.dtype.names is None:
+        if data.ndim > 2:
+            raise ValueError("Only 1 or 2 dimensional arrays can be passed "
+                             "to GMT.")
+        
+        dtype = data.dtype.newbyteorder("=")
+        ncols = 1 if data.ndim == 1 else data.shape[1]
+        
+        desc = "{}{}".format(ncols, binary_code(dtype))
+        data = np.ascontiguousarray(data, dtype)
+    else:
+        # native byte order, no padding between the fields
+        fields = [(name, data.dtype[name].base.newbyteorder("="),
+                   data.dtype[name].shape)
+                  for name in data.dtype.names]
+        dtype = np.dtype(fields)
+        
+        desc = ",".join("{}{}".format(int(np.prod(shape, dtype=int)),
+                                      binary_code(base))
+                        for _, base, shape in fields)
+        
+        # repacked only if needed
+        if dtype != data.dtype:
+            packed = np.empty(data.shape, dtype)
+            
+            for name in dtype.names:
+                packed[name] = data[name]
+            
+            data = packed
+        
+        data = np.ascontiguousarray(data)
+    
+    return "-bi{}".format(desc), memoryview(data.reshape(-1).view(np.uint8))
+
+
 def gen_tuple(cast):
     """
     Returns a function that creates a tuple of elements found in x.
@@ -0,0 +1,174 @@
+# Copyright (C) 2018  István Bozsó
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+from ctypes import CDLL, c_char_p, c_int, c_uint, c_void_p
+from ctypes.util import find_library
+from functools import lru_cache
+from threading import Lock
+
+
+# GMT_Call_Module mode: options are passed as a single string
+GMT_MODULE_CMD = 0
+
+
+class GMTError(RuntimeError):
+    pass
+
+
+def library_path():
+    """
+    Path of the GMT shared library, taken from the GMT_LIBRARY environment
+    variable or searched for in the standard locations. None if it is not
+    found.
+    """
+    return os.environ.get("GMT_LIBRARY", find_library("gmt"))
+
+
+@lru_cache(maxsize=None)
+def load(path):
+    """
+    Loads the GMT shared library `path` once and declares the signatures
+    of the functions used.
+    """
+    lib = CDLL(path)
+
+    lib.GMT_Create_Session.argtypes = (c_char_p, c_uint, c_uint, c_void_p)
+    lib.GMT_Create_Session.restype = c_void_p
+    lib.GMT_Call_Module.argtypes = (c_void_p, c_char_p, c_int, c_void_p)
+    lib.GMT_Call_Module.restype = c_int
+    lib.GMT_Destroy_Session.argtypes = (c_void_p,)
+    lib.GMT_Destroy_Session.restype = c_int
+
+    return lib
+
+
+class Session(object):
+    """
+    GMT C API session loaded through ctypes. Modules are executed inside
+    the running process, without starting a new gmt process every time.
+    Output written by the modules to the standard output is redirected to
+    the requested file. The defaults (gmt.conf) are read when the session
+    is created.
+    """
+    __slots__ = ("lib", "libc", "api", "lock")
+
+    def __init__(self, path=None):
+        if path is None:
+            path = library_path()
+
+        if path is None:
+            raise GMTError("The GMT library could not be found, set the "
+                           "GMT_LIBRARY environment variable.")
+
+        # the C library of the process, needed to flush stdio buffers
+        self.lib, self.libc, self.lock = load(path), CDLL(None), Lock()
+        self.api = None
+
+        self.open()
+
+
+    def open(self):
+        # 2 is the default grid padding of the gmt executable
+        self.api = self.lib.GMT_Create_Session(b"utils", 2, 0, None)
+
+        if not self.api:
+            self.api = None
+            raise GMTError("Failed to create GMT session.")
+
+
+    def reopen(self):
+        """
+        Replaces the GMT session with a new one, e.g. to read the defaults
+        after gmt.conf changed.
+        """
+        self.close()
+
+        with self.lock:
+            self.open()
+
+
+    def call(self, module, args, out=None):
+        """
+        Execute GMT `module` with the options in `args`. Its standard
+        output is written to the binary file object `out` (discarded if it
+        is None).
+        """
+        if self.api is None:
+            raise GMTError("GMT session is closed.")
+
+        # file descriptor 1 belongs to the whole process, one module runs
+        # at a time
+        with self.lock:
+            sys.stdout.flush()
+            self.libc.fflush(None)
+
+            if out is None:
+                target = os.open(os.devnull, os.O_WRONLY)
+            else:
+                out.flush()
+                target = os.dup(out.fileno())
+
+            saved = os.dup(1)
+
+            try:
+                os.dup2(target, 1)
+
+                status = self.lib.GMT_Call_Module(self.api, module.encode(),
+                                                  GMT_MODULE_CMD,
+                                                  args.encode())
+                self.libc.fflush(None)
+            finally:
+                os.dup2(saved, 1)
+                os.close(saved)
+                os.close(target)
+
+        if status != 0:
+            raise GMTError("GMT module '%s %s' failed with status %d"
+                           % (module, args, status))
+
+
+    def close(self):
+        with self.lock:
+            if self.api is not None:
+                self.lib.GMT_Destroy_Session(self.api)
+                self.api = None
+
+
+_available = None
+
+
+def library():
+    """
+    Returns a new GMT library session or None if the library is not
+    available. The library is only looked for once, the session has to be
+    closed by the caller.
+    """
+    global _available
+
+    if _available is False:
+        return None
+
+    try:
+        session = Session()
+    except (GMTError, OSError):
+        _available = False
+        return None
+
+    _available = True
+
+    return session
@@ -15,33 +15,47 @@
 
 from __future__ import print_function
 
+import os
+import re
 import os.path as pth
-import numpy as np
 
 from os import mkdir
 from builtins import str
 from numbers import Number
-from tempfile import mkstemp
+from tempfile import mkstemp, TemporaryFile
 from os import fdopen, path as pth
 from sys import stderr, platform
 from atexit import register
 import subprocess as sub
 from tempfile import _get_default_tempdir, _get_candidate_names
-from time import sleep
+from time import sleep, time, perf_counter
+from threading import Lock
+from contextvars import ContextVar
 from shlex import split
 from sys import maxsize
-from functools import partial
+from functools import partial, lru_cache
 from hashlib import sha224
 from collections import namedtuple
-from shutil import move
+from collections.abc import Iterable
+from shutil import copy
 from itertools import tee, takewhile, islice, chain, filterfalse
+from os import cpu_count
+from uuid import uuid4
+from contextlib import contextmanager
 
 try:
-    from IPython.display import Image, display
+    from xxhash import xxh3_128 as fast_hash
 except ImportError:
-    Image = None
+    from hashlib import blake2b
+    fast_hash = partial(blake2b, digest_size=16)
 
-from utils import *
+from utils import new_type
+from .session import Session, Pool, Fifo, GnuplotError
+from .private import MultiPlot
+from . import cache
+
+# numpy, IPython, asyncio and the gnuplot.lod module are only imported by
+# the functions that need them, importing the package stays cheap
 
 
 config = {
@@ -50,6 +64,22 @@ config = {
     "silent": False,
     "exe": "gnuplot",
     "size": (800, 600),
+    # number of persistent gnuplot processes plots are dispatched to;
+    # 0 means a new gnuplot process is started for every plot
+    "sessions": 0,
+    # how array data reaches gnuplot: "file" (cached .dat files),
+    # "inline" (streamed after the plot command) or "fifo" (named pipes)
+    "transport": "file",
+    # memory-mapped arrays and arrays larger than this many bytes are
+    # written to the data cache in blocks of this size
+    "chunk": 2 ** 26,
+    # reduce huge (x, y) point series to what is visible at "size"
+    "lod": False,
+    # maximum number of plots remembered by the in-memory render index
+    "memo": 10000,
+    # callable receiving a dict of timings for every rendered plot, or the
+    # path of a JSON lines log they are appended to; None disables it
+    "profile": None,
     
     "2D":
     """
@@ -72,16 +102,10 @@ config = {
 
     
 
-tmp_path = pth.join(_get_default_tempdir(), "gnuplot")
-data_path = pth.join(tmp_path, "data")
-gp_path = pth.join(tmp_path, "tmp.gp")
-
 
-if not pth.isdir(tmp_path):
-    mkdir(tmp_path)
 
-if not pth.isdir(data_path):
-    mkdir(data_path)
+class DataError(ValueError):
+    pass
 
 
 def phash(data):
@@ -89,13 +113,67 @@ def phash(data):
 
     
 def phash_arr(*items):
-    return phash(item.dump() for item in items)
+    return phash("".join(array_digest(item) for item in items).encode())
+
+
+def array_digest(data):
+    """
+    Hashes the buffer of array `data` without copying it (unless it is
+    not C contiguous). dtype, shape and strides are hashed as well, so
+    the same bytes with a different layout give a different digest.
+    """
+    import numpy as np
+    
+    data = np.ascontiguousarray(data)
+    
+    with timed("hash"):
+        h = fast_hash()
+        h.update(("%r %s %s" % (data.dtype.descr, data.shape, data.strides))
+                 .encode())
+        h.update(data.data.cast("B"))
+    
+    return h.hexdigest()
     
     
 def update(**kwargs):
     config.update(kwargs)
 
 
+def command():
+    if config["persist"]:
+        return "%s --persist" % config["exe"]
+    else:
+        return config["exe"]
+
+
+_pool = None
+
+
+def pool():
+    """
+    Returns the pool of persistent gnuplot sessions, (re)creating it if
+    the configuration changed since the last call.
+    """
+    global _pool
+    
+    cmd, size = command(), config["sessions"]
+    
+    if _pool is None or _pool.cmd != cmd or _pool.size != size:
+        close_pool()
+        _pool = Pool(cmd, size)
+    
+    return _pool
+
+
+@register
+def close_pool():
+    global _pool
+    
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+
 def make_property(name):
     mangled = "_%s" % name
     
@@ -116,7 +194,7 @@ def number(item):
     
     
 def numbers(item, ntype, brackets=False):
-    if not isinstance(item iterable):
+    if not isinstance(item, Iterable):
         raise TypeError("Expected an iterable %s" % (item))
     
     numbers = (number(elem) for elem in item)
@@ -125,8 +203,8 @@ def numbers(item, ntype, brackets=False):
         ret = ":".join(numbers)
     elif ntype == "tuple":
         ret = ",".join(numbers)
-    elif ntype == 
-    
+    else:
+        raise ValueError('ntype should be either "range" or "tuple"')
     
     if brackets == "square":
         ret = "[%s]" % ret
@@ -147,7 +225,7 @@ def string(item, quoted=True):
 label = partial(string, quoted=False)
 
 def labels(item):
-    if not isinstance(item iterable):
+    if not isinstance(item, Iterable):
         raise TypeError("Expected an iterable %s" % (item))
     
     labels = (label(elem) for elem in item)
@@ -192,16 +270,27 @@ def make_property(name, validator):
 
 
 def properties(cls):
-    options = cls.__options__
-    attribs = options.attribs
+    """
+    Turns the options declared by `cls` (in `__options__` or as class
+    attributes defaulting to None) into properties of a slotted class
+    that can format itself into gnuplot set commands.
+    """
+    try:
+        options = cls.__options__
+        prefix, attribs = options.prefix, options.attribs
+    except AttributeError:
+        prefix = cls.prefix
+        attribs = {key: val for key, val in vars(cls).items()
+                   if not key.startswith("_") and key != "prefix"}
+    
     names = tuple(attribs.keys())
     cname = cls.__name__
     
-    prefix = options.prefix
-    
-    nt = new_type(cname, names)
-    
-    
+    def init(self, name=None, **kwargs):
+        self.prefix = prefix if name is None else "%s%s" % (name, prefix)
+        
+        for key in names:
+            setattr(self, key, kwargs.get(key, attribs[key]))
     
     def iter(self):
         for key in names:
@@ -212,29 +301,20 @@ def properties(cls):
                "; ".join("%s: %s" % (key, val) for key, val in self))
     
     def parse(self):
-        prefix = self.prefix
-        
-        return "\n".join(parse_set(key, val, prefix)
+        return "\n".join(parse_set(key, val, self.prefix)
                          for key, val in self
                          if val is not None)
     
-    if hasattr(cls, "__slots__"):
-        mangled += getattr(cls, "__slots__")
-    
-    nt.update({
+    callables = {
         "__init__": init,
-        "__slots__": names + ("prefix",),
+        "__slots__": ("prefix",) + tuple("_%s" % key for key in names),
         "__str__": tostring,
         "__iter__": iter,
-        "parse": parse
-        # "prefix": prefix
-        # "__options__": cls.options,
-        # "__option_names__": tuple(cls.options.keys()),
-    })
-    
+        "parse": parse,
+    }
     
-    for key, val in attribs.items():
-        callables[key] = make_property(key)
+    for key in names:
+        callables[key] = make_property(key, lambda item: item)
     
     return type(cname, (object,), callables)
 
@@ -266,16 +346,12 @@ class Figure(object):
     __slots__ = fslots
     
     __options__ = options(
-        size=numbers()
+        size=None
     )
     
     def __init__(self):
         self.multi = None
-        
-        if config["persist"]:
-            self.cmd = "%s --persist" % config["exe"]
-        else:
-            self.cmd = config["exe"]
+        self.cmd = command()
         
         self.xtics = Tics(name="x"), Tics(name="y"), Tics(name="z")
         # self.x, self.y, self.z = Axis("x"), Axis("y"), Axis("z")
@@ -298,7 +374,11 @@ class Figure(object):
     
     
     def __hash__(self):
-        return phash((self.sets, tuple(self.commands)))
+        return hash(self.state())
+    
+    def state(self):
+        return (tuple(self.global_sets.items()), tuple(self.sets.items()),
+                tuple(self.commands), self.palette)
     
     def __setitem__(self, item, val):
         self.sets[item] = val
@@ -341,6 +421,7 @@ class Figure(object):
                                      "tmargin", "bmargin"}})
         
     def path(self, data):
+        tmp_path, _ = cache.paths()
         return pth.join(tmp_path, "%s" % (phash(data.encode("ascii"))))
     
     
@@ -348,10 +429,28 @@ class Figure(object):
         self["style line %d" % stylenum] = \
         "%s" % (linedef(ltype, **kwargs))
     
-    def refresh(self, plot_cmd, *items, **kwargs):
+    def script(self, plot_cmd, *items, **kwargs):
+        """
+        Assembles the gnuplot script for plotting `items` and resets the
+        figure. Returns the path of the output file, the script text and
+        the data that has to be streamed to gnuplot.
+        """
         assert plot_cmd in {"plot", "splot"}
         
-        term(**kwargs)
+        body = "%s %s\n" % (plot_cmd, ", ".join(plot.command for plot in items))
+        
+        payloads = tuple(item.payload for item in items
+                         if getattr(item, "payload", None) is not None)
+        
+        return self.assemble(body, payloads, **kwargs)
+    
+    
+    def assemble(self, body, payloads=(), **kwargs):
+        """
+        Prepends the settings and commands of the figure to the plotting
+        commands `body` and resets the figure.
+        """
+        self["terminal"], self.ext = term(**kwargs)
         
         txt = "%s\n%s\n%s\n" % (
             "\n".join(parse_set(key, val)
@@ -363,47 +462,97 @@ class Figure(object):
         
         
         if self.palette is not None:
-            txt = "%s\n%s" % (txt, self.palette)
+            # named palettes are loaded from a file written only once
+            if self.palette in color_palettes:
+                txt = "%s\n%s" % (txt, palette(self.palette))
+            else:
+                txt = "%s\n%s" % (txt, self.palette)
         
-        txt = "%s\n%s %s\n" %  (txt,
-                                plot_cmd,
-                                ", ".join(plot.command for plot in items))
+        txt = "%s\n%s" % (txt, body)
         
-        path = "%s.%s" % (self.path(txt), self.ext)
+        # streamed data does not appear in the script, its hash has to be
+        # part of the output name
+        key = "".join(payload.key for payload in payloads)
+        path = "%s.%s" % (self.path(txt + key), self.ext)
         
+        self.sets, self.commands, self.count = {}, [], 0
         
-        if not pth.isfile(path):
-            txt = "set output '%s'\n%s" % (path, txt)
-            
-            # assert len({item.ptype for item in items}) == 1
-            # ptype = items[0].ptype
-            
-            with open(gp_path, "w") as f:
-                f.write(txt)
-            
-            try:
-                sub.check_output(split("%s %s" % (self.cmd, gp_path)),
-                                 stderr=sub.STDOUT)
-            except sub.CalledProcessError as e:
-                print(e.output.decode())
-                raise e
+        return Script(path, txt, payloads)
+    
+    
+    def refresh(self, plot_cmd, *items, **kwargs):
+        # plots of unchanged figures are looked up from the in-memory index
+        # without assembling the script
+        try:
+            key = (plot_cmd, tuple(kwargs.items()), self.state(),
+                   tuple(item.command for item in items),
+                   tuple(item.payload.key for item in items
+                         if getattr(item, "payload", None) is not None),
+                   tuple(config[name] for name in memo_config))
+            plot = rendered().get(key)
+        except TypeError:
+            # unhashable settings
+            key, plot = None, None
         
+        # the file may have been evicted from the cache by another process;
+        # the lookup also marks it as recently used
+        if plot is not None and not cache.lookup(plot.path):
+            del rendered()[key]
+            plot = None
         
-        self.sets, self.commands, self.count = {}, [], 0
+        if plot is not None:
+            self.sets, self.commands, self.count = {}, [], 0
+            profile(plot.path, True)
+            return plot
         
-        return Plot(path)
+        with timed("script"):
+            script = self.script(plot_cmd, *items, **kwargs)
         
+        plot = render(*script)
+        
+        if key is not None and config["memo"] > 0:
+            index = rendered()
+            
+            if len(index) >= config["memo"]:
+                index.clear()
+            
+            index[key] = plot
+        
+        return plot
+    
+    
+    def multiplot(self, multi, **kwargs):
+        """
+        Renders all panels of `MultiPlot` `multi` with a single gnuplot run.
+        """
+        return render(*self.assemble(multi.script(), tuple(multi.payloads),
+                                     **kwargs))
+    
+    
+    async def arefresh(self, plot_cmd, *items, **kwargs):
+        return await arender(*self.script(plot_cmd, *items, **kwargs))
+    
+    
+    async def aplot(self, *items, **kwargs):
+        return await self.arefresh("plot", *items, **kwargs)
+    
+    
+    async def asplot(self, *items, **kwargs):
+        return await self.arefresh("splot", *items, **kwargs)
+    
+    
     def plot_ipython(self, plot_cmd, *items, **kwargs):
+        Image, display = ipython()
+        
         if Image is not None:
             kwargs.setdefault("term", "pngcairo")
-            
-            if not silent:
-                path = self.refresh(plot_cmd, *items, **kwargs)
-            
-            display(Image(filename=str(path)))
-            return path
-        elif not silent:
-            return refresh(plot_cmd, *items, **kwargs)
+        
+        plot = self.refresh(plot_cmd, *items, **kwargs)
+        
+        if Image is not None and not config["silent"]:
+            display(Image(filename=plot.path))
+        
+        return plot
         
         
     def plot(self, *items, **kwargs):
@@ -413,9 +562,501 @@ class Figure(object):
         return self.plot_ipython("splot", *items, **kwargs)
 
 
+class LiveFigure(Figure):
+    """
+    Figure attached to its own long-lived gnuplot session. Data is kept
+    in gnuplot datablocks, `append` only sends the new rows and `replot`
+    redraws the output from the data gnuplot already has.
+    
+        fig = LiveFigure()
+        fig.append("sensor", t, v)
+        fig.plot(fig.block("sensor", using="1:2", vith="lines"),
+                 term="pngcairo")
+        ...
+        fig.append("sensor", t_new, v_new)
+        fig.replot()
+    """
+    __slots__ = ("session", "output", "last")
+    
+    def __init__(self):
+        Figure.__init__(self)
+        
+        self.session, self.output, self.last = Session(command()), None, None
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    
+    def block(self, name, ptype="2D", **kwargs):
+        """
+        Plot description reading datablock `name`.
+        """
+        return PlotDescription(ptype, "$%s" % name, **kwargs)
+    
+    
+    def clear(self, name):
+        """
+        Empties (or creates) datablock `name`.
+        """
+        self.session.run("$%s << EOD\nEOD" % name)
+    
+    
+    def append(self, name, *arrays, fmt="%.17g"):
+        """
+        Appends the rows formed by the columns `arrays` to datablock `name`.
+        """
+        import numpy as np
+        from io import StringIO
+        
+        data = np.column_stack(arrays)
+        
+        # every row becomes a print command of a single quoted string
+        rows = StringIO()
+        np.savetxt(rows, data,
+                   fmt="print '%s'" % " ".join((fmt,) * data.shape[1]))
+        
+        # printing has to be redirected to stdout again, the session
+        # reads its acknowledgements from there
+        self.session.run('set print $%s append\n%sset print "-"'
+                         % (name, rows.getvalue()))
+    
+    
+    def refresh(self, plot_cmd, *items, **kwargs):
+        _, txt, payloads = self.script(plot_cmd, *items, **kwargs)
+        
+        if self.output is None:
+            self.output = pth.join(_get_default_tempdir(), "gnuplot-live-%s.%s"
+                                   % (uuid4().hex, self.ext))
+        
+        self.last = txt, payloads
+        
+        return self.render(txt, payloads)
+    
+    
+    def replot(self):
+        """
+        Redraws the last plot with the current content of the datablocks.
+        """
+        assert self.last is not None, "Nothing has been plotted yet"
+        
+        txt, payloads = self.last
+        
+        # inline data has to be sent again, the whole script is rerun
+        if not payloads:
+            txt = "replot"
+        
+        return self.render(txt, payloads)
+    
+    
+    def render(self, txt, payloads=()):
+        with scratch(self.output) as part:
+            txt = "set output '%s'\n%s" % (part, txt)
+            
+            with streamed(txt, payloads) as (txt, inline):
+                try:
+                    self.session.run(txt, inline)
+                except GnuplotError:
+                    # the session is killed if it read data as commands,
+                    # the datablocks are lost with it
+                    if not self.session.alive():
+                        self.session = Session(self.session.cmd)
+                    
+                    raise
+        
+        return Plot(self.output)
+    
+    
+    def close(self):
+        self.session.close()
+        
+        if self.output is not None and pth.isfile(self.output):
+            os.remove(self.output)
+
+
+Script = namedtuple("Script", "path text payloads")
+
+
+_ipython = None
+
+
+def ipython():
+    """
+    Returns the IPython Image class and display function, or Nones if
+    IPython is not available.
+    """
+    global _ipython
+    
+    if _ipython is None:
+        try:
+            from IPython.display import Image, display
+        except ImportError:
+            Image, display = None, None
+        
+        _ipython = Image, display
+    
+    return _ipython
+
+
+_rendered, _generation = {}, 0
+
+# configuration the rendered scripts and files depend on, part of the keys
+# of the render index
+memo_config = ("size", "exe", "persist")
+
+
+def rendered():
+    """
+    Index of the plots rendered by this process keyed by figure state.
+    It is dropped whenever files are evicted from the cache.
+    """
+    global _generation
+    
+    if cache.generation != _generation:
+        _rendered.clear()
+        _generation = cache.generation
+    
+    return _rendered
+
+
+@contextmanager
+def streamed(txt, payloads):
+    """
+    Starts streaming `payloads` through named pipes where needed. Yields
+    the script to execute and the buffers of data to send after it on
+    stdin, produced while they are consumed.
+    """
+    inline, fifos = [], []
+    
+    try:
+        for payload in payloads:
+            if payload.fifo is None:
+                inline.append(payload.data)
+            else:
+                # unique name so the same data can be plotted by multiple
+                # renders at once; payloads of the same data share the
+                # placeholder, every one of them takes the first reference
+                # still left, so each reference gets its own pipe
+                fifo = "%s.%s.fifo" % (pth.splitext(payload.fifo)[0],
+                                       uuid4().hex)
+                txt = txt.replace("'%s'" % payload.fifo, "'%s'" % fifo, 1)
+                fifos.append(Fifo(fifo, buffers(payload.data)))
+        
+        yield txt, chain.from_iterable(buffers(data) for data in inline)
+    finally:
+        for fifo in fifos:
+            fifo.close()
+
+
+@contextmanager
+def scratch(path):
+    """
+    Yields a unique temporary name for `path`. The file written there is
+    atomically renamed to `path` at the end of the block, so concurrent
+    writers and readers never see a partially written file.
+    """
+    part = "%s.%s.part" % (path, uuid4().hex)
+    
+    try:
+        yield part
+        
+        if pth.isfile(part):
+            os.replace(part, path)
+    finally:
+        if pth.isfile(part):
+            os.remove(part)
+
+
+# stages of the profile record being collected by the current thread or
+# asyncio task; batches hand every job the stages collected for it
+_stages, _profile_lock = ContextVar("stages", default=None), Lock()
+
+
+@contextmanager
+def timed(stage):
+    """
+    Adds the time spent in the block to `stage` of the profile record of
+    the current thread or task if profiling is enabled. Can be used as a
+    decorator as well.
+    """
+    if config["profile"] is None:
+        yield
+        return
+    
+    start = perf_counter()
+    
+    try:
+        yield
+    finally:
+        stages = _stages.get()
+        
+        if stages is None:
+            stages = {}
+            _stages.set(stages)
+        
+        stages[stage] = stages.get(stage, 0.0) + perf_counter() - start
+
+
+def collected():
+    """
+    Returns the stages collected since the last profile record and starts
+    a new record.
+    """
+    stages = _stages.get()
+    _stages.set(None)
+    
+    return stages or {}
+
+
+def resume(stages):
+    """
+    Continues the profile record of the stages `stages` collected
+    elsewhere (e.g. while assembling the script of a batch job) in the
+    current thread or task.
+    """
+    _stages.set(dict(stages))
+
+
+def profile(path, cached):
+    """
+    Emits the timings collected by `timed` since the last record of the
+    thread or task together with the size of plot `path`, then starts a
+    new record.
+    """
+    target = config["profile"]
+    
+    if target is None:
+        return
+    
+    record = dict(collected(), path=str(path), cached=cached, time=time())
+    
+    try:
+        record["size"] = pth.getsize(path)
+    except OSError:
+        record["size"] = None
+    
+    if callable(target):
+        target(record)
+    else:
+        import json
+        
+        line = "%s\n" % json.dumps(record)
+        
+        with _profile_lock, open(target, "a") as f:
+            f.write(line)
+
+
+def render(path, txt, payloads=(), sessions=None):
+    """
+    Runs script `txt` writing the plot to `path` unless it already exists.
+    The script is executed by `sessions` if it is given, by the global
+    session pool if it is enabled, or by a new gnuplot process otherwise.
+    """
+    with timed("lookup"):
+        cached = cache.lookup(path)
+    
+    if not cached:
+        with scratch(path) as part:
+            txt = "set output '%s'\n%s" % (part, txt)
+            
+            with streamed(txt, payloads) as (txt, inline), timed("gnuplot"):
+                if sessions is None and config["sessions"] > 0:
+                    sessions = pool()
+                
+                if sessions is not None:
+                    sessions.run(txt, inline)
+                else:
+                    run_gnuplot(txt, inline)
+        
+        cache.store(path)
+    
+    profile(path, cached)
+    
+    return Plot(path)
+
+
+def run_gnuplot(txt, inline=()):
+    """
+    Runs script `txt` with a new gnuplot process. The script and the
+    buffers of `inline` data go through stdin one after the other, the
+    data is never joined in memory.
+    """
+    cmd = split(command())
+    
+    # output goes to a file, gnuplot can not get stuck on a full pipe
+    # while the data is still being sent
+    with TemporaryFile() as out:
+        proc = sub.Popen(cmd, stdin=sub.PIPE, stdout=out, stderr=sub.STDOUT)
+        
+        try:
+            for buf in chain([txt.encode()], inline):
+                proc.stdin.write(buf)
+        except BrokenPipeError:
+            # gnuplot stopped reading, its output tells why
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        
+        if proc.wait() != 0:
+            out.seek(0)
+            output = out.read()
+            
+            print(output.decode())
+            raise sub.CalledProcessError(proc.returncode, cmd, output)
+
+
+def batch_scripts(figures):
+    """
+    Assembles the scripts of the `figures` jobs of `render_many` and
+    `aplot_many`. Returns them together with the profile stages collected
+    for every output path.
+    """
+    jobs, stages = [], {}
+    
+    for job in figures:
+        fig, plot_cmd, items = job[:3]
+        kwargs = job[3] if len(job) > 3 else {}
+        
+        with timed("script"):
+            jobs.append(fig.script(plot_cmd, *items, **kwargs))
+        
+        stages.setdefault(jobs[-1].path, collected())
+    
+    return jobs, stages
+
+
+def render_many(figures, workers=None):
+    """
+    Renders many plots concurrently. `figures` is an iterable of
+    (Figure, plot_cmd, items) or (Figure, plot_cmd, items, kwargs) jobs.
+    Scripts are assembled serially, then executed by `workers` gnuplot
+    sessions in parallel. Returns the `Plot` objects in the order of the
+    jobs.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    jobs, stages = batch_scripts(figures)
+    
+    if workers is None and config["sessions"] > 0:
+        sessions, owned = pool(), False
+    else:
+        sessions, owned = Pool(command(), workers or cpu_count()), True
+    
+    # identical scripts would write the same output file concurrently
+    unique = {job.path: job for job in jobs}
+    
+    def run(job):
+        resume(stages[job.path])
+        return render(*job, sessions=sessions)
+    
+    try:
+        with cache.pinned(cached_files(jobs)), \
+             ThreadPoolExecutor(sessions.size) as executor:
+            tuple(executor.map(run, unique.values()))
+    finally:
+        if owned:
+            sessions.close()
+    
+    return [Plot(job.path) for job in jobs]
+
+
+async def arender(path, txt, payloads=()):
+    """
+    Asynchronous version of `render`, gnuplot is run as an asyncio
+    subprocess so the event loop is not blocked while it works.
+    """
+    import asyncio
+    
+    with timed("lookup"):
+        cached = cache.lookup(path)
+    
+    if not cached:
+        cmd = split(command())
+        
+        with scratch(path) as part:
+            txt = "set output '%s'\n%s" % (part, txt)
+            
+            with streamed(txt, payloads) as (txt, inline), timed("gnuplot"):
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd, stdin=sub.PIPE, stdout=sub.PIPE, stderr=sub.STDOUT)
+                
+                # the output is read meanwhile, gnuplot can not get stuck
+                # on a full pipe while the data is still being sent
+                reader = asyncio.ensure_future(proc.stdout.read())
+                
+                try:
+                    for buf in chain([txt.encode()], inline):
+                        proc.stdin.write(buf)
+                        await proc.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    # gnuplot stopped reading, its output tells why
+                    pass
+                finally:
+                    proc.stdin.close()
+                
+                output = await reader
+                await proc.wait()
+            
+            if proc.returncode != 0:
+                print(output.decode())
+                raise sub.CalledProcessError(proc.returncode, cmd, output)
+        
+        cache.store(path)
+    
+    profile(path, cached)
+    
+    return Plot(path)
+
+
+async def aplot_many(figures, limit=None):
+    """
+    Asynchronous version of `render_many`, at most `limit` gnuplot
+    processes are run at the same time.
+    """
+    import asyncio
+    
+    jobs, stages = batch_scripts(figures)
+    
+    semaphore = asyncio.Semaphore(limit or cpu_count())
+    unique = {job.path: job for job in jobs}
+    
+    # every task runs in its own context, the stages are not mixed
+    async def run(job):
+        async with semaphore:
+            resume(stages[job.path])
+            return await arender(*job)
+    
+    with cache.pinned(cached_files(jobs)):
+        await asyncio.gather(*(run(job) for job in unique.values()))
+    
+    return [Plot(job.path) for job in jobs]
+
+
+def cached_files(scripts):
+    """
+    Files of the cache the `scripts` read (data and style files) and
+    write. They have to stay in place until the scripts are run, storing
+    the results of other scripts may prune the cache in the meantime.
+    """
+    tmp_path, _ = cache.paths()
+    quoted = re.compile(r"'(%s[^']+)'" % re.escape(pth.join(tmp_path, "")))
+    
+    return set(chain.from_iterable(quoted.findall(script.text)
+                                   for script in scripts)) \
+           | {script.path for script in scripts}
+
+
 class Plot(namedtuple("Plot", "path")):
     def save(self, path):
-        move(self.path, path)
+        # the cached file stays in place, the render index may return it
+        copy(self.path, path)
 
 
 @properties
@@ -476,7 +1117,48 @@ class Axis(object):
     format = property(get_format, set_format)
     
 
+@timed("convert")
 def data(*arrays, ltype="points", **kwargs):
+    """
+    The arrays are plotted as columns with style `ptype` (`ltype` by
+    default) or `vith`. With `lod` (config["lod"] by default) an (x, y)
+    series is reduced to what is visible at config["size"] in that style.
+    The explicit axis settings of the figure have to be passed as
+    `xrange`, `yrange` and `logscale` for the reduction to match them,
+    e.g. data(x, y, lod=True, xrange=(0, 10), logscale="y").
+    """
+    import numpy as np
+    
+    xrange, yrange, logscale = \
+    kwargs.pop("xrange", None), kwargs.pop("yrange", None), \
+    kwargs.pop("logscale", "")
+    
+    kwargs.setdefault("ptype", ltype)
+    
+    if kwargs.pop("lod", config["lod"]) and len(arrays) == 2:
+        from .lod import decimate
+        
+        # the style actually drawn, e.g. "lines" of vith="lines lw 2"
+        style = (kwargs.get("vith") or kwargs["ptype"]).split()
+        
+        idx = decimate(arrays[0], arrays[1], style[0], config["size"],
+                       xrange, yrange, logscale)
+        
+        if idx is not None:
+            arrays = tuple(np.asarray(arr)[idx] for arr in arrays)
+    
+    if chunked(*arrays):
+        # the rows of a 2D array are the columns, as with np.vstack; a
+        # memmap yields them as views
+        if len(arrays) == 1 and np.ndim(arrays[0]) == 2:
+            columns = tuple(arrays[0])
+        else:
+            columns = arrays
+        
+        if all(np.ndim(col) == 1 for col in columns):
+            text, payload = columns_source(columns)
+            return PlotDescription("2D", text, payload=payload, **kwargs)
+    
     try:
         data = np.vstack(arrays).T
     except TypeError:
@@ -486,14 +1168,18 @@ def data(*arrays, ltype="points", **kwargs):
     if data.ndim > 2:
         raise DataError("Only 1 or 2 dimensional arrays can be plotted!")
     
-    text = convert_data(data, **kwargs)
+    text, payload = convert_data(data, **kwargs)
     
-    return PlotDescription("2D", text, **kwargs)
+    return PlotDescription("2D", text, payload=payload, **kwargs)
 
 
+@timed("convert")
 def grid(data, x=None, y=None, **kwargs):
+    import numpy as np
     
-    data = np.asarray(data, np.float32)
+    # memory-mapped data is converted block by block while writing
+    if not isinstance(data, np.memmap):
+        data = np.asarray(data, np.float32)
     
     try:
         (rows, cols) = data.shape
@@ -517,16 +1203,45 @@ def grid(data, x=None, y=None, **kwargs):
         if y.shape != (rows,):
             raise DataError("y should have number of elements equal to "
                             "the number of rows of data!")
-        
+    
+    if chunked(data):
+        text, payload = matrix_source(data, x, y)
+        return PlotDescription("3D", text, payload=payload, **kwargs)
+    
     grid        = np.zeros((rows + 1, cols + 1), np.float32)
     grid[0,0]   = cols
     grid[0,1:]  = x
     grid[1:,0]  = y
     grid[1:,1:] = data.astype(np.float32)
     
-    text = convert_data(grid, grid=True, **kwargs)
+    text, payload = convert_data(grid, grid=True, **kwargs)
     
-    return PlotDescription("3D", text, **kwargs)
+    return PlotDescription("3D", text, payload=payload, **kwargs)
+
+
+def heatmap(data, palette="jet", cbrange=None):
+    """
+    Renders 2D array `data` with palette `palette` of `color_palettes`
+    straight to a PNG image, without running gnuplot. Only the colour
+    mapped data is drawn, meant for thumbnails of many grids.
+    """
+    from .png import heatmap as write_heatmap
+    
+    key = "%s %s %s" % (array_digest(data), palette, cbrange)
+    path = pth.join(cache.paths()[0], "%s.png" % phash(key.encode()))
+    
+    with timed("lookup"):
+        cached = cache.lookup(path)
+    
+    if not cached:
+        with scratch(path) as part, timed("render"):
+            write_heatmap(part, data, color_palettes[palette], cbrange)
+        
+        cache.store(path)
+    
+    profile(path, cached)
+    
+    return Plot(path)
 
     
 def histo(edges, hist, **kwargs):
@@ -606,30 +1321,409 @@ def file(data, matrix=None, binary=None, array=None, endian="default",
     return PlotDescription("2D", text, **kwargs)
 
 
+Payload = namedtuple("Payload", "key data fifo")
+
+
 def convert_data(data, grid=False, **kwargs):
-    bytes = data.dumps()
-    path = pth.join(data_path, "%s.dat" % phash(bytes))
+    """
+    Returns the gnuplot data source text for `data` and the `Payload` that
+    has to be streamed to gnuplot (None if the data was written to the
+    file cache).
+    """
+    import numpy as np
     
-    if not pth.isfile(path):
-        data.tofile(path)
-        # with open(path, "wb") as f:
-        #     f.write(bytes)
+    # fmt_dict describes native byte order only
+    data = np.asarray(data)
+    data = np.ascontiguousarray(data, data.dtype.newbyteorder("="))
+    key = array_digest(data)
     
     if grid:
         add = "binary matrix"
     else:
         add = arr_bin(data)
     
-    return "'%s' %s" % (path, add)
+    transport = data_transport(grid)
+    
+    if transport == "file":
+        return "'%s' %s" % (cache_array(data, key), add), None
+    
+    return stream_source(key, data, add, transport)
+
+
+def data_transport(grid=False):
+    """
+    How data reaches gnuplot: config["transport"] unless the data layout
+    or the platform does not allow it.
+    """
+    transport = config["transport"]
+    
+    # the end of an inline binary matrix can not be determined by gnuplot
+    if transport == "inline" and grid:
+        transport = "fifo"
+    
+    if transport == "fifo" and not hasattr(os, "mkfifo"):
+        transport = "file"
+    
+    return transport
+
+
+def stream_source(key, data, add, transport):
+    """
+    Data source text and `Payload` of `data` streamed to gnuplot inline
+    or through a named pipe.
+    """
+    if transport == "inline":
+        return "'-' %s" % add, Payload(key, data, None)
+    
+    fifo = pth.join(cache.paths()[0], "%s.fifo" % key)
+    return "'%s' %s" % (fifo, add), Payload(key, data, fifo)
+
+
+def cache_array(data, key=None):
+    """
+    Writes C contiguous array `data` into the data cache unless it is
+    already there. Returns the path to the data file.
+    """
+    if key is None:
+        key = array_digest(data)
+    
+    path = pth.join(cache.paths()[1], "%s.dat" % key)
+    
+    if not cache.lookup(path):
+        with scratch(path) as part, open(part, "wb") as f:
+            f.write(data.data.cast("B"))
+        
+        cache.store(path)
+    
+    return path
+
+
+@timed("convert")
+def records(data, lengths=None):
+    """
+    Writes structured (record) array `data` into the data cache once and
+    returns a `Records` object that describes its fields for gnuplot.
+    
+    Parameters
+    ----------
+    data : numpy structured array
+        One dimensional array with named fields.
+    lengths : iterable of ints, optional
+        Number of records in consecutive groups of `data`. Every group
+        becomes a separate gnuplot dataset that can be selected with the
+        `index` argument of `Records.plot`.
+    """
+    import numpy as np
+    
+    data = np.asarray(data)
+    
+    if data.dtype.names is None or data.ndim != 1:
+        raise DataError("data should be a one dimensional structured "
+                        "array!")
+    
+    # native byte order, no padding between the fields
+    fields = [(name, data.dtype[name].base.newbyteorder("="),
+               data.dtype[name].shape)
+              for name in data.dtype.names]
+    dtype = np.dtype(fields)
+    
+    if dtype != data.dtype:
+        packed = np.empty(data.shape, dtype)
+        
+        for name in dtype.names:
+            packed[name] = data[name]
+        
+        data = packed
+    
+    data = np.ascontiguousarray(data)
+    
+    if lengths is None:
+        lengths = (len(data),)
+    else:
+        lengths = tuple(int(length) for length in lengths)
+        
+        if sum(lengths) != len(data):
+            raise DataError("Group lengths should add up to the number of "
+                            "records!")
+    
+    fmt, columns, ncol = "", {}, 1
+    
+    for name, base, shape in fields:
+        count = int(np.prod(shape, dtype=int))
+        fmt += count * fmt_dict[base.name]
+        columns[name] = ncol
+        ncol += count
+    
+    return Records(cache_array(data), fmt, columns, lengths)
+
+
+class Records(object):
+    __slots__ = ("path", "format", "columns", "lengths")
+    
+    def __init__(self, path, format, columns, lengths):
+        self.path, self.format, self.columns, self.lengths = \
+        path, format, columns, lengths
+    
+    
+    def __len__(self):
+        return len(self.lengths)
+    
+    
+    def source(self):
+        return "'%s' binary record=%s format='%s'" \
+               % (self.path, ":".join(str(length) for length in self.lengths),
+                  self.format)
+    
+    
+    def using(self, *fields):
+        """
+        Converts field names to gnuplot column numbers, anything else
+        (e.g. expressions) is passed through.
+        """
+        return ":".join(str(self.columns.get(field, field))
+                        for field in fields)
+    
+    
+    def plot(self, *fields, index=None, every=None, **kwargs):
+        """
+        Plots `fields` of the records; `index` selects a group, `every`
+        is passed to gnuplot as is.
+        """
+        text = self.source()
+        
+        if index is not None:
+            text += " index %d" % index
+        
+        if every is not None:
+            text += " every %s" % every
+        
+        text += " using %s" % self.using(*fields)
+        
+        return PlotDescription("2D", text, **kwargs)
+
+
+def chunked(*arrays):
+    """
+    Whether `arrays` should be written to the data cache block by block
+    instead of combining them in memory first.
+    """
+    import numpy as np
+    
+    return any(isinstance(arr, np.memmap) for arr in arrays) or \
+           sum(np.asarray(arr).nbytes for arr in arrays) > config["chunk"]
+
+
+def block_rows(dtype, ncols):
+    return max(1, config["chunk"] // (dtype.itemsize * ncols))
+
+
+def layout_hash(dtype, shape):
+    """
+    Hash object fed with the dtype, shape and strides of a C contiguous
+    array, the way `array_digest` starts.
+    """
+    strides, step = [], dtype.itemsize
+    
+    for dim in reversed(shape):
+        strides.append(step)
+        step *= dim
+    
+    h = fast_hash()
+    h.update(("%r %s %s" % (dtype.descr, shape, tuple(reversed(strides))))
+             .encode())
+    
+    return h
+
+
+class Blocks(object):
+    """
+    Payload data produced block by block every time it is iterated, it is
+    never held in memory as a whole. `blocks` returns an iterator of
+    arrays, they are converted to `dtype`.
+    """
+    __slots__ = ("blocks", "dtype")
+    
+    def __init__(self, blocks, dtype):
+        self.blocks, self.dtype = blocks, dtype
+    
+    
+    def __iter__(self):
+        import numpy as np
+        
+        for block in self.blocks():
+            yield np.ascontiguousarray(block, self.dtype).data.cast("B")
+
+
+def block_source(blocks, dtype, shape, add, grid=False):
+    """
+    Data source text and `Payload` (None if the data went to the file
+    cache) of the `shape` shaped, `dtype` typed array produced by
+    `blocks`, a function returning an iterator of its consecutive blocks.
+    Streamed data is read twice: once for its hash, once for gnuplot.
+    """
+    transport = data_transport(grid)
+    
+    if transport == "file":
+        return "'%s' %s" % (write_blocks(blocks(), dtype, shape), add), None
+    
+    data, h = Blocks(blocks, dtype), layout_hash(dtype, shape)
+    
+    with timed("hash"):
+        for buf in data:
+            h.update(buf)
+    
+    return stream_source(h.hexdigest(), data, add, transport)
+
+
+def write_blocks(blocks, dtype, shape):
+    """
+    Writes `blocks` of a `shape` shaped, `dtype` typed C contiguous array
+    into the data cache. The hash is computed while writing and is the
+    same as the `array_digest` of the whole array. Returns the path to the
+    data file.
+    """
+    import numpy as np
+    
+    _, data_path = cache.paths()
+    h = layout_hash(dtype, shape)
+    
+    fd, tmp = mkstemp(dir=data_path, suffix=".part")
+    
+    try:
+        with fdopen(fd, "wb") as f:
+            for block in blocks:
+                buf = np.ascontiguousarray(block, dtype).data.cast("B")
+                h.update(buf)
+                f.write(buf)
+        
+        path = pth.join(data_path, "%s.dat" % h.hexdigest())
+        
+        if cache.lookup(path):
+            os.remove(tmp)
+        else:
+            os.replace(tmp, path)
+            cache.store(path)
+    except:
+        if pth.isfile(tmp):
+            os.remove(tmp)
+        raise
+    
+    return path
+
+
+def columns_source(arrays):
+    """
+    Data source of 1D `arrays` as the columns of a binary array. It is
+    assembled block by block, the whole combined array is never created.
+    """
+    import numpy as np
+    
+    dtype, nrows, ncols = np.result_type(*arrays).newbyteorder("="), \
+                          len(arrays[0]), len(arrays)
+    step = block_rows(dtype, ncols)
+    
+    if any(len(arr) != nrows for arr in arrays):
+        raise DataError("Input arrays should have the same length!")
+    
+    def blocks():
+        for start in range(0, nrows, step):
+            stop = min(start + step, nrows)
+            block = np.empty((stop - start, ncols), dtype)
+            
+            for ii, arr in enumerate(arrays):
+                block[:, ii] = arr[start:stop]
+            
+            yield block
+    
+    return block_source(blocks, dtype, (nrows, ncols),
+                        record_format(dtype, (nrows, ncols)))
+
+
+def matrix_source(data, x, y):
+    """
+    Data source of `data` in the gnuplot binary matrix layout (number of
+    columns and x coordinates in the first row, y coordinates in the first
+    column) processing a bounded number of rows at a time.
+    """
+    import numpy as np
+    
+    f32 = np.dtype(np.float32)
+    rows, cols = data.shape
+    step = block_rows(f32, cols + 1)
+    
+    def blocks():
+        head = np.empty(cols + 1, f32)
+        head[0], head[1:] = cols, x
+        
+        yield head
+        
+        for start in range(0, rows, step):
+            stop = min(start + step, rows)
+            block = np.empty((stop - start, cols + 1), f32)
+            block[:, 0], block[:, 1:] = y[start:stop], data[start:stop]
+            
+            yield block
+    
+    return block_source(blocks, f32, (rows + 1, cols + 1), "binary matrix",
+                        grid=True)
+
+
+def array_buffer(data):
+    import numpy as np
+    
+    return np.ascontiguousarray(data).data
+
+
+def buffers(data):
+    """
+    Buffers of payload data `data`, an array or `Blocks`, to be sent to
+    gnuplot one after the other.
+    """
+    if isinstance(data, Blocks):
+        return iter(data)
+    
+    return (array_buffer(data),)
     
 
 def palette(pal):
-    session.palette = color_palettes[pal]
+    """
+    Command loading palette `pal` of `color_palettes`. Assigning the name
+    of the palette to `Figure.palette` has the same effect.
+    """
+    return "load '%s'" % style_file(color_palettes[pal])
+
+
+_styles = {}
+
+
+def style_file(text):
+    """
+    Writes gnuplot commands `text` (palette or style definitions) into
+    the data cache unless it is already there. Returns the path of the
+    file, scripts `load` it instead of repeating (and rehashing) the text.
+    """
+    path = _styles.get(text)
+    
+    if path is None:
+        path = pth.join(cache.paths()[1], "%s.gp" % phash(text.encode()))
+        _styles[text] = path
+    
+    # the file could have been evicted from the cache in the meantime
+    if not cache.lookup(path):
+        with scratch(path) as part, open(part, "w") as f:
+            f.write(text)
+        
+        cache.store(path)
+    
+    return path
 
 
 def multiplot(nplot, **kwargs):
-    raise NotImplemented("Multiplot functionality still in the works.")
-#     return gp.MultiPlot(nplot, _session, **kwargs)
+    """
+    Starts collecting the panels of a multiplot, render them with
+    `Figure.multiplot`.
+    """
+    return MultiPlot(nplot, **kwargs)
 
 
     
@@ -651,10 +1745,13 @@ def title(title):
 
 
 def term(term, size=None, **kwargs):
+    """
+    Returns the terminal setting and the extension of the output file for
+    gnuplot terminal `term`.
+    """
     enhanced = bool(kwargs.pop("enhanced", False))
     
-    
-    session.ext = term2ext[term]
+    ext = term2ext[term]
     
     if enhanced:
         term += " enhanced"
@@ -668,7 +1765,7 @@ def term(term, size=None, **kwargs):
     if "font" in kwargs or "fontsize" in kwargs:
         term += font(**kwargs)
     
-    set(terminal=term)
+    return term, ext
 
 
 def font(font="Verdena", fontsize=12.0):
@@ -769,9 +1866,10 @@ sym = type("Symbols", (object,), {
 
 
 class PlotDescription(object):
-    def __init__(self, ptype, command, **kwargs):
-        self.ptype, self.command = \
-        ptype, command + parse_plot_arguments(**kwargs)
+    # "ptype" of kwargs is the plot style passed to parse_plot_arguments
+    def __init__(self, kind, command, payload=None, **kwargs):
+        self.ptype, self.command, self.payload = \
+        kind, command + parse_plot_arguments(**kwargs), payload
     
     def __str__(self):
         return self.command
@@ -789,10 +1887,14 @@ class PlotDescription(object):
 
 def arr_bin(array):
     if array.ndim == 1:
-        return " binary format='%s'" % (len(array) * gp.fmt_dict[array.dtype])
+        return " binary format='%s'" % (len(array) * fmt_dict[array.dtype.name])
     elif array.ndim == 2:
-        fmt = array.shape[1] * fmt_dict[array.dtype]
-        return " binary record=%d format='%s'" % (array.shape[0], fmt)
+        return " %s" % record_format(array.dtype, array.shape)
+
+
+def record_format(dtype, shape):
+    fmt = shape[1] * fmt_dict[dtype.name]
+    return "binary record=%d format='%s'" % (shape[0], fmt)
 
 
 def linedef(ltype, **kwargs):
@@ -887,18 +1989,27 @@ equaled = frozenset({
 })
 
 
-def parse_option(key, value):
+@lru_cache(maxsize=None)
+def option_template(key):
+    """
+    Formatting template of option `key`, depending on whether its value
+    has to be quoted and/or joined with an equal sign.
+    """
     f = lambda x: x in key
     qtd, eqd = any(map(f, quoted)), any(map(f, equaled))
     
     if qtd and eqd:
-        return "%s='%s'" % (key, value)
+        return "%s='%s'"
     elif qtd:
-        return "%s '%s'" % (key, value)
+        return "%s '%s'"
     elif eqd:
-        return "%s=%s" % (key, value)
+        return "%s=%s"
     else:
-        return "%s %s" % (key, value)
+        return "%s %s"
+
+
+def parse_option(key, value):
+    return option_template(key) % (key, value)
 
 
 def proc_using(txt):
@@ -1005,21 +2116,20 @@ term2ext = {
 }
 
 
-dtype = np.dtype
-
+# keyed by numpy dtype names
 fmt_dict = {
-    dtype("float64"): "%float64",
-    dtype("float32"): "%float",
-    
-    dtype("int8"): "%int8",
-    dtype("int16"): "%int16",
-    dtype("int32"): "%int32",
-    dtype("int64"): "%int64",
-    
-    dtype("uint8"): "%uint8",
-    dtype("uint16"): "%uint16",
-    dtype("uint32"): "%uint32",
-    dtype("uint64"): "%uint64"
+    "float64": "%float64",
+    "float32": "%float",
+    
+    "int8": "%int8",
+    "int16": "%int16",
+    "int32": "%int32",
+    "int64": "%int64",
+    
+    "uint8": "%uint8",
+    "uint16": "%uint16",
+    "uint32": "%uint32",
+    "uint64": "%uint64"
 }
 
 
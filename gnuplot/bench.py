@@ -0,0 +1,227 @@
+# Copyright (C) 2018  István Bozsó
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks of the hot paths of the gnuplot wrapper and of the import
+time of the packages.
+
+Rendering is measured against a stub gnuplot executable that only
+creates the output file and acknowledges session scripts, so the numbers
+reflect the overhead of the wrapper, not of gnuplot itself.
+
+    python -m gnuplot.bench --save baseline.json
+    python -m gnuplot.bench --compare baseline.json
+"""
+
+import os
+import sys
+import json
+import os.path as pth
+import subprocess as sub
+
+from time import perf_counter
+from shutil import rmtree
+from tempfile import mkdtemp
+from argparse import ArgumentParser
+
+import numpy as np
+
+import gnuplot as gp
+
+
+stub = r'''#!%s
+import re
+import sys
+
+args = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+src = open(args[0], "rb") if args else sys.stdin.buffer
+
+for line in src:
+    line = line.decode(errors="replace")
+    match = re.match(r"set output '(.*)'", line)
+
+    if match:
+        open(match.group(1), "w").close()
+
+    match = re.match(r'print sprintf\("%%s %%d %%s", "(\S+)"', line)
+
+    if match:
+        print(match.group(1), 0, "", flush=True)
+'''
+
+
+def make_stub(directory):
+    path = pth.join(directory, "gnuplot")
+
+    with open(path, "w") as f:
+        f.write(stub % sys.executable)
+
+    os.chmod(path, 0o755)
+
+    return path
+
+
+def timeit(fun, repeat):
+    """
+    Calls `fun(ii)` `repeat` times, returns the timings in seconds.
+    """
+    times = []
+
+    for ii in range(repeat):
+        start = perf_counter()
+        fun(ii)
+        times.append(perf_counter() - start)
+
+    return times
+
+
+def imports():
+    """
+    Startup cost of importing the packages in a fresh interpreter, bare
+    interpreter startup is measured as a reference.
+    """
+    root = pth.dirname(pth.dirname(pth.abspath(__file__)))
+
+    def run(code):
+        return lambda ii: sub.check_call((sys.executable, "-c", code),
+                                         cwd=root)
+
+    return (
+        ("python_startup", run("pass")),
+        ("import_utils", run("import utils")),
+        ("import_gnuplot", run("import gnuplot")),
+    )
+
+
+def benchmarks(rows):
+    x = np.linspace(0.0, 1.0, rows)
+    y = np.sin(x)
+    z = np.random.rand(int(rows ** 0.5), int(rows ** 0.5)).astype(np.float32)
+
+    # a value changing between calls and runs defeats the data and plot
+    # caches (they persist across processes) where needed
+    seed = np.random.rand()
+
+    def convert_data(ii):
+        arr = np.vstack((x, y + seed + ii)).T
+        gp.convert_data(arr)
+
+    def data(ii):
+        gp.data(x, y + seed + ii)
+
+    def grid(ii):
+        gp.grid(z + seed + ii)
+
+    item = gp.data(x, y)
+
+    def script(ii):
+        fig = gp.Figure()
+        fig("# %d" % ii)
+        fig.script("plot", item, term="pngcairo")
+
+    def render(ii, tag="process"):
+        fig = gp.Figure()
+        fig("# %s %s %d" % (tag, seed, ii))
+        fig.refresh("plot", item, term="pngcairo")
+
+    def render_session(ii):
+        gp.update(sessions=1)
+
+        try:
+            render(ii, "session")
+        finally:
+            gp.update(sessions=0)
+
+    return (
+        ("convert_data", convert_data),
+        ("data", data),
+        ("grid", grid),
+        ("script", script),
+        ("render", render),
+        ("render_session", render_session),
+    )
+
+
+def report(results, baseline=None, threshold=0.2):
+    """
+    Prints the timings, comparing them to `baseline` if it is given.
+    Returns the names of the benchmarks that became slower by more than
+    `threshold` (relative).
+    """
+    slower = []
+
+    print("%-16s %12s %12s %10s" % ("benchmark", "min [ms]", "mean [ms]",
+                                    "change"))
+
+    for name, times in results.items():
+        best, mean = min(times), sum(times) / len(times)
+        change = ""
+
+        if baseline is not None and name in baseline:
+            ratio = best / min(baseline[name]) - 1.0
+            change = "%+.1f%%" % (100.0 * ratio)
+
+            if ratio > threshold:
+                slower.append(name)
+
+        print("%-16s %12.3f %12.3f %10s" % (name, 1e3 * best, 1e3 * mean,
+                                            change))
+
+    return slower
+
+
+def main():
+    ap = ArgumentParser(description=__doc__)
+
+    ap.add_argument("--rows", type=int, default=10 ** 6,
+                    help="Number of data points.")
+    ap.add_argument("--repeat", type=int, default=10,
+                    help="Number of runs of every benchmark.")
+    ap.add_argument("--save", help="Save timings to this JSON file.")
+    ap.add_argument("--compare", help="Compare timings to this JSON file.")
+    ap.add_argument("--threshold", type=float, default=0.2,
+                    help="Relative slowdown reported as a regression.")
+
+    args = ap.parse_args()
+
+    directory = mkdtemp()
+    gp.update(exe=make_stub(directory))
+
+    try:
+        results = {name: timeit(fun, args.repeat)
+                   for name, fun in imports() + benchmarks(args.rows)}
+    finally:
+        gp.close_pool()
+        rmtree(directory)
+
+    baseline = None
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    slower = report(results, baseline, args.threshold)
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if slower:
+        print("Regressions: %s" % ", ".join(slower))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# Copyright (C) 2018  István Bozsó
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path as pth
+
+from time import time
+from threading import Lock
+from tempfile import gettempdir
+from contextlib import contextmanager
+
+__all__ = (
+    "update", "paths", "lookup", "store", "prune", "pinned", "stats",
+)
+
+
+config = {
+    # upper limit for the total size of the cached files in bytes
+    "size": 2 ** 30,
+    # files not used for this many seconds are removed, None means no limit
+    "age": None,
+}
+
+
+counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+# incremented every time files are evicted from the cache
+generation = 0
+
+# total size of the cached files, None until the cache is first scanned
+_total = None
+_paths = None
+_lock = Lock()
+
+# number of users of the files that must not be evicted, keyed by path
+_pins = {}
+
+
+def update(**kwargs):
+    config.update(kwargs)
+
+
+def paths():
+    """
+    Returns the directory of rendered plots and the directory of data
+    files, creating them on first use.
+    """
+    global _paths
+
+    if _paths is None:
+        tmp_path = pth.join(gettempdir(), "gnuplot")
+        data_path = pth.join(tmp_path, "data")
+
+        os.makedirs(data_path, exist_ok=True)
+
+        _paths = tmp_path, data_path
+
+    return _paths
+
+
+def lookup(path):
+    """
+    Returns whether `path` is in the cache. Hits are marked as recently
+    used by updating their access time, so they are evicted last.
+    """
+    try:
+        os.utime(path, None)
+    except OSError:
+        hit = False
+    else:
+        hit = True
+
+    with _lock:
+        counters["hits" if hit else "misses"] += 1
+
+    return hit
+
+
+def store(path):
+    """
+    Registers the newly written file `path` and prunes the cache if it
+    grew over its size budget.
+    """
+    global _total
+
+    try:
+        size = pth.getsize(path)
+    except OSError:
+        return
+
+    with _lock:
+        if _total is None:
+            _total = sum(entry.stat().st_size for entry in entries())
+        else:
+            _total += size
+
+        full = _total > config["size"]
+
+    if full:
+        prune()
+
+
+def entries():
+    for directory in paths():
+        for entry in os.scandir(directory):
+            # skip named pipes and files still being written
+            if entry.is_file(follow_symlinks=False) \
+               and not entry.name.endswith(".part"):
+                yield entry
+
+
+def prune(size=None, age=None):
+    """
+    Removes the least recently used files until the cache fits into `size`
+    bytes, and every file not used for more than `age` seconds. Pinned
+    files are kept. Defaults are taken from `config`. Returns the number
+    of removed files.
+    """
+    global _total, generation
+
+    if size is None:
+        size = config["size"]
+
+    if age is None:
+        age = config["age"]
+
+    with _lock:
+        files = sorted((entry.stat().st_atime, entry.stat().st_size,
+                        entry.path) for entry in entries())
+
+        total, now, removed = sum(elem[1] for elem in files), time(), 0
+
+        for atime, fsize, path in files:
+            if total <= size and (age is None or now - atime <= age):
+                break
+
+            if path in _pins:
+                continue
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total -= fsize
+            removed += 1
+
+        _total = total
+        counters["evictions"] += removed
+
+        if removed:
+            generation += 1
+
+    return removed
+
+
+@contextmanager
+def pinned(paths):
+    """
+    Protects the files `paths` from eviction while the context is active,
+    e.g. the data files of scripts that are still to be run.
+    """
+    paths = frozenset(paths)
+
+    with _lock:
+        for path in paths:
+            _pins[path] = _pins.get(path, 0) + 1
+
+    try:
+        yield
+    finally:
+        with _lock:
+            for path in paths:
+                if _pins[path] > 1:
+                    _pins[path] -= 1
+                else:
+                    del _pins[path]
+
+
+def stats():
+    """
+    Returns the hit, miss and eviction counters together with the number
+    and total size of the cached files.
+    """
+    files = tuple(entry.stat().st_size for entry in entries())
+
+    with _lock:
+        ret = dict(counters)
+
+    ret.update(files=len(files), size=sum(files), limit=config["size"])
+
+    return ret
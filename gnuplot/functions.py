@@ -13,7 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from utils.gnuplot import linedef
+from .base import linedef
 import numpy as np
 
 def plot_scatter(gp, data, ncols, out=None, title=None, idx=None, titles=None,
@@ -41,11 +41,20 @@ def plot_scatter(gp, data, ncols, out=None, title=None, idx=None, titles=None,
     
 
 def groupby_plot(gp, x, y, data, by, colors, **kwargs):
-    fields = np.unique(data[by])
-    
-    indices = (np.where(data[by] == field) for field in fields)
-    ldefs = (linedef("points", rgb=cols[color], **kwargs) for color in colors)
-    
-    return (gp.data(data[x][idx], data[y][idx], vith=ldef,
-            title="{} {}".format(by, field))
-            for field, idx, ldef in zip(fields, indices, ldefs))
+    """
+    Plots `y` against `x` for every distinct value of field `by` of
+    structured array `data`. The data is sorted by group once and written
+    to a single file, groups are selected with gnuplot's `index`.
+    """
+    fields, inverse, counts = np.unique(data[by], return_inverse=True,
+                                        return_counts=True)
+    
+    # stable sort keeps the original order of the points inside groups
+    order = np.argsort(inverse, kind="stable")
+    records = gp.records(data[[x, y]][order], counts)
+    
+    ldefs = (linedef("points", rgb=color, **kwargs) for color in colors)
+    
+    return (records.plot(x, y, index=ii, vith=ldef,
+                         title="{} {}".format(by, field))
+            for ii, (field, ldef) in enumerate(zip(fields, ldefs)))
@@ -0,0 +1,147 @@
+# Copyright (C) 2018  István Bozsó
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Level of detail reduction of point series. Only the points that can
+change the rendered image at the given output resolution are kept.
+"""
+
+from numbers import Number
+
+import numpy as np
+
+__all__ = (
+    "decimate", "decimate_lines", "decimate_points",
+)
+
+
+# plot styles drawing connected series, abbreviations included
+line_styles = frozenset({
+    "l", "lines", "lp", "linespoints", "steps", "fsteps", "histeps",
+})
+
+
+def bounds(values, limits=None):
+    """
+    Visible interval of `values`: `limits` (lower, upper), the missing or
+    non-numeric ones (e.g. "*" for autoscale) taken from the data.
+    """
+    lo, hi = (None, None) if limits is None else limits
+
+    if not isinstance(lo, Number):
+        lo = np.min(values)
+
+    if not isinstance(hi, Number):
+        hi = np.max(values)
+
+    return lo, hi
+
+
+def pixel(values, npix, limits=None):
+    """
+    Pixel indices of `values` spread over `npix` pixels between `limits`.
+    Values outside of them are put into the pixels -1 and `npix`.
+    """
+    lo, hi = bounds(values, limits)
+
+    if hi == lo:
+        return np.zeros(len(values), np.intp)
+
+    pix = np.floor((values - lo) * ((npix - 1) / (hi - lo)))
+
+    return np.clip(pix, -1, npix).astype(np.intp)
+
+
+def decimate_lines(x, y, width, xrange=None):
+    """
+    Indices of the first, last, minimum and maximum points in every pixel
+    column. `x` has to be sorted.
+    """
+    ncol = pixel(x, width, xrange)
+
+    # start indices of the pixel columns
+    first = np.flatnonzero(np.r_[True, ncol[1:] != ncol[:-1]])
+    last = np.r_[first[1:], len(x)] - 1
+
+    # sort by y inside every pixel column
+    order = np.lexsort((y, ncol))
+
+    return np.unique(np.concatenate((first, last, order[first],
+                                     order[last])))
+
+
+def decimate_points(x, y, width, height, xrange=None, yrange=None):
+    """
+    Indices of one point per occupied pixel, in their original order.
+    """
+    cell = (pixel(y, height, yrange) + 1) * (width + 2) \
+           + pixel(x, width, xrange) + 1
+
+    _, idx = np.unique(cell, return_index=True)
+
+    return np.sort(idx)
+
+
+def decimate(x, y, ltype="points", size=(800, 600), xrange=None,
+             yrange=None, logscale=""):
+    """
+    Returns the indices of the points of the (`x`, `y`) series worth
+    sending to gnuplot at output resolution `size`, or None if no
+    reduction is possible. Lines keep the extremes of every pixel column,
+    other plot types keep one point per pixel.
+
+    `xrange` and `yrange` are the (lower, upper) limits of the axes if
+    they are set explicitly, `logscale` names the logarithmic axes
+    ("x", "y" or "xy"), just like the gnuplot settings of the same name.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    width, height = size
+
+    # pixels are evenly spaced on the logarithm of logscale axes
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if "x" in logscale:
+            x = np.log10(x)
+            xrange = logs(xrange)
+
+        if "y" in logscale:
+            y = np.log10(y)
+            yrange = logs(yrange)
+
+    finite = np.isfinite(x) & np.isfinite(y)
+
+    if ltype in line_styles:
+        # only sorted series can be reduced column by column, gaps
+        # (non-finite values) have to be kept to break the lines
+        if len(x) <= 4 * width or not finite.all() \
+           or np.any(np.diff(x) < 0):
+            return None
+
+        return decimate_lines(x, y, width, xrange)
+
+    if len(x) <= width * height:
+        return None
+
+    idx = np.flatnonzero(finite)
+
+    return idx[decimate_points(x[idx], y[idx], width, height, xrange,
+                               yrange)]
+
+
+def logs(limits):
+    if limits is None:
+        return None
+
+    return tuple(np.log10(limit) if isinstance(limit, Number)
+                 else limit for limit in limits)
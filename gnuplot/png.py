@@ -0,0 +1,139 @@
+# Copyright (C) 2018  István Bozsó
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process rendering of grids into PNG images, without gnuplot. Only the
+colour mapped data is drawn (no border, tics or colorbox), which is all a
+thumbnail needs.
+"""
+
+import re
+import zlib
+import struct
+
+from functools import lru_cache
+
+import numpy as np
+
+__all__ = (
+    "palette_lut", "colorize", "write_png", "heatmap",
+)
+
+
+signature = b"\x89PNG\r\n\x1a\n"
+
+
+@lru_cache(maxsize=None)
+def palette_lut(text, size=256):
+    """
+    Parses the "set palette defined (...)" command of the gnuplot script
+    `text` into a lookup table of `size` RGB colors (uint8 array of shape
+    (size, 3)).
+    """
+    # continuation lines are joined first
+    match = re.search(r"set palette defined\s*\((.*?)\)",
+                      text.replace("\\\n", ""), re.DOTALL)
+
+    if match is None:
+        raise ValueError("No 'set palette defined' command found!")
+
+    pos, rgb = [], []
+
+    for entry in match.group(1).split(","):
+        elems = entry.split()
+
+        if not elems:
+            continue
+
+        pos.append(float(elems[0]))
+
+        if len(elems) == 2:
+            color = elems[1].strip("'\"").lstrip("#")
+            rgb.append(tuple(int(color[ii:ii + 2], 16) / 255.0
+                             for ii in (0, 2, 4)))
+        else:
+            rgb.append(tuple(float(elem) for elem in elems[1:4]))
+
+    pos, rgb = np.array(pos), np.array(rgb)
+
+    # gnuplot maps the first and last positions to the ends of the range
+    pos = (pos - pos[0]) / (pos[-1] - pos[0])
+    grid = np.linspace(0.0, 1.0, size)
+
+    lut = np.column_stack([np.interp(grid, pos, rgb[:, ii])
+                           for ii in range(3)])
+
+    return np.rint(255.0 * lut).astype(np.uint8)
+
+
+def colorize(data, lut, cbrange=None, nan=(255, 255, 255)):
+    """
+    Maps 2D array `data` through `lut` into an RGB image. Values are
+    scaled linearly between the ends of `cbrange` (the minimum and maximum
+    of the data by default), NaNs get color `nan`.
+    """
+    data = np.asarray(data, np.float32)
+
+    if cbrange is None:
+        lo, hi = np.nanmin(data), np.nanmax(data)
+    else:
+        lo, hi = cbrange
+
+    scale = (len(lut) - 1) / (hi - lo) if hi != lo else 0.0
+
+    finite = np.isfinite(data)
+    idx = np.zeros(data.shape, np.intp)
+
+    idx[finite] = np.clip((data[finite] - lo) * scale, 0, len(lut) - 1)
+
+    rgb = lut[idx]
+    rgb[~finite] = nan
+
+    return rgb
+
+
+def chunk(tag, data):
+    return b"".join((struct.pack(">I", len(data)), tag, data,
+                     struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)))
+
+
+def write_png(path, rgb, level=6):
+    """
+    Writes uint8 image `rgb` of shape (rows, cols, 3) into PNG file `path`.
+    """
+    rows, cols, _ = rgb.shape
+
+    # every scanline starts with its filter type, 0 means no filtering
+    raw = np.zeros((rows, 3 * cols + 1), np.uint8)
+    raw[:, 1:] = rgb.reshape(rows, -1)
+
+    header = struct.pack(">IIBBBBB", cols, rows, 8, 2, 0, 0, 0)
+
+    with open(path, "wb") as f:
+        f.write(signature)
+        f.write(chunk(b"IHDR", header))
+        f.write(chunk(b"IDAT", zlib.compress(raw.data, level)))
+        f.write(chunk(b"IEND", b""))
+
+
+def heatmap(path, data, palette, cbrange=None, level=6):
+    """
+    Renders 2D array `data` with the palette defined by gnuplot script
+    `palette` into PNG file `path`. The first row of `data` is drawn at
+    the bottom, as gnuplot does.
+    """
+    rgb = colorize(data, palette_lut(palette), cbrange)
+
+    write_png(path, rgb[::-1], level)
@@ -13,18 +13,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from sys import platform, stderr
-from os import linesep, popen, remove
-from numpy import dtype
 from math import ceil, sqrt
-from weakref import ref
-import subprocess as sub
     
     
 class MultiPlot(object):
-    def __init__(self, nplot, session, **kwargs):
-        self.session = ref(session)()
-        
+    """
+    Collects the panels of a multiplot into a single script, so all of
+    them are rendered by one gnuplot run (see `Figure.multiplot`).
+    """
+    def __init__(self, nplot, **kwargs):
         common_keys = bool(kwargs.get("ckeys", False))
         
         if common_keys:
@@ -39,6 +36,9 @@ class MultiPlot(object):
         self.width_total = self.width * nplot + self.between * (nplot - 1) \
                            + self.left + self.key_height
         
+        # screen margins of every panel (and of the common key)
+        self.edges = tuple(self.margins(ii) for ii in range(nplot + 1))
+        
         nrows = kwargs.get("nrows", None)
         
         if nrows is None:
@@ -67,11 +67,11 @@ class MultiPlot(object):
         if common_keys:
             txt += "; unset key"
         
-        self.session(txt)
+        self.commands, self.payloads = [txt], []
     
     
     def __call__(self, *args):
-        self.session(*args)
+        self.commands.extend(args)
     
     
     def key(self, *titles):
@@ -90,28 +90,44 @@ class MultiPlot(object):
         unset ylabel
         set yrange [0:1]
         plot %s
-        """ % (self.margins(self.nplot)[0] - 0.35, plot))
+        """ % (self.edges[self.nplot][0] - 0.35, plot))
     
     
-    def plot(self, ii, txt):
-        sess = self.session
+    def plot(self, ii, *items, plot_cmd="plot"):
+        """
+        Adds panel `ii` plotting `items` (`PlotDescription` objects or
+        plain strings).
+        """
+        for item in items:
+            payload = getattr(item, "payload", None)
+            
+            if payload is None:
+                continue
+            
+            # gnuplot would read inline data right after the plot command
+            # of the panel, but it is only sent at the end of the script
+            if payload.fifo is None:
+                raise ValueError("Inline data cannot be used in multiplots, "
+                                 "use the 'file' or 'fifo' transport.")
+            
+            self.payloads.append(payload)
         
         if ii > 0:
             self("unset ylabel")
         
-        self("set lmargin at screen %g\nset rmargin at screen %g" % self.margins(ii))
-        sess(txt)
+        self("set lmargin at screen %g\nset rmargin at screen %g"
+             % self.edges[ii])
+        self("%s %s" % (plot_cmd, ", ".join(str(item) for item in items)))
     
     
     def margins(self, ii):
         l, b, w = self.left, self.between, self.width
         left = ii * (w + b) + l
         return left, left + w
-
     
-    def __del__(self):
-        self.session("unset multiplot")
-        self.session.multi = None
+    
+    def script(self):
+        return "%s\nunset multiplot\n" % "\n".join(self.commands)
 
 
 #if platform == "mac":
@@ -0,0 +1,258 @@
+# Copyright (C) 2018  István Bozsó
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import subprocess as sub
+
+from uuid import uuid4
+from shlex import split
+from threading import Lock, Thread
+from contextlib import contextmanager
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+
+class GnuplotError(RuntimeError):
+    pass
+
+
+class Session(object):
+    """
+    A long-lived gnuplot process that is fed scripts over its standard
+    input. After every script an acknowledgement line, tagged with a
+    sentinel unique to the session, is printed to the standard output
+    together with the error state of gnuplot, so we know exactly when
+    the script finished and whether it succeeded.
+    """
+    __slots__ = ("cmd", "proc", "sentinel")
+
+    ack_tpl = 'print sprintf("%%s %%d %%s", "%s", GPVAL_ERRNO, GPVAL_ERRMSG)'
+
+    def __init__(self, cmd):
+        if isinstance(cmd, str):
+            cmd = split(cmd)
+
+        self.cmd, self.sentinel = tuple(cmd), "__gnuplot_%s__" % uuid4().hex
+
+        # "-" makes gnuplot read commands from stdin interactively, so an
+        # error in one script does not terminate the whole session
+        self.proc = sub.Popen(self.cmd + ("-",), stdin=sub.PIPE,
+                              stdout=sub.PIPE, stderr=sub.DEVNULL,
+                              universal_newlines=True, bufsize=1)
+
+        self.write('set print "-"\n')
+
+
+    def alive(self):
+        return self.proc.poll() is None
+
+
+    def write(self, *chunks):
+        """
+        Writes script text (str) and inline binary data (bytes-like) to
+        the standard input of gnuplot.
+        """
+        stdin = self.proc.stdin
+
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    stdin.write(chunk)
+                else:
+                    stdin.flush()
+                    stdin.buffer.write(chunk)
+                    stdin.buffer.flush()
+        except (BrokenPipeError, ValueError):
+            raise GnuplotError("gnuplot session '%s' is not running "
+                               "(returncode: %s)"
+                               % (" ".join(self.cmd), self.proc.poll()))
+
+
+    # clears the state left behind by the previous script: settings,
+    # variables, functions, datablocks and an unfinished multiplot; the
+    # terminal is not reset, every rendered script sets its own
+    clean_tpl = 'unset multiplot\nreset session\nset print "-"\n'
+
+    def run(self, txt, payloads=(), clean=False):
+        """
+        Execute script `txt` and wait for gnuplot to finish it. `payloads`
+        (an iterable of buffers) are written right after the script, they
+        are read by the "'-'" data sources of the last plot command. If
+        `clean` is True, gnuplot is reset to its initial state first.
+        Returns the lines gnuplot printed in the meantime. The session is
+        killed if a script with payloads fails.
+        """
+        if clean:
+            self.write(self.clean_tpl)
+
+        self.write("reset errors\n%s\n" % txt.rstrip("\n"))
+
+        inline = False
+
+        for payload in payloads:
+            self.write(payload)
+            inline = True
+
+        try:
+            return self.acknowledged(txt)
+        except GnuplotError:
+            # a command failing before its "'-'" data was read makes
+            # gnuplot read the binary data as commands, the session can
+            # not be trusted anymore
+            if inline:
+                self.kill()
+
+            raise
+
+
+    def acknowledged(self, txt):
+        """
+        Waits for the acknowledgement of script `txt`, returns the lines
+        printed before it.
+        """
+        self.write("unset output\n%s\n" % (self.ack_tpl % self.sentinel))
+        self.proc.stdin.flush()
+
+        sentinel, lines = self.sentinel, []
+
+        for line in iter(self.proc.stdout.readline, ""):
+            if line.startswith(sentinel):
+                errno, _, msg = line[len(sentinel):].strip().partition(" ")
+
+                if int(errno) != 0:
+                    raise GnuplotError("gnuplot error %s: %s\n"
+                                       "while executing script:\n%s"
+                                       % (errno, msg, txt))
+
+                return lines
+
+            lines.append(line)
+
+        raise GnuplotError("gnuplot session '%s' terminated unexpectedly "
+                           "(returncode: %s)"
+                           % (" ".join(self.cmd), self.proc.wait()))
+
+
+    def kill(self):
+        self.proc.kill()
+        self.close()
+
+
+    def close(self):
+        if self.alive():
+            try:
+                self.proc.stdin.write("exit\n")
+                self.proc.stdin.close()
+            except (BrokenPipeError, ValueError):
+                pass
+
+        self.proc.wait()
+
+
+class Pool(object):
+    """
+    A fixed number of gnuplot sessions. Sessions are started on first use
+    and restarted transparently if one of them dies (or is killed after a
+    failed script).
+    """
+    __slots__ = ("cmd", "size", "idle", "sessions", "lock")
+
+    def __init__(self, cmd, size):
+        assert size > 0, "Pool size should be a positive number"
+
+        self.cmd, self.size, self.idle, self.sessions, self.lock = \
+        cmd, size, Queue(), [], Lock()
+
+        for _ in range(size):
+            self.idle.put(None)
+
+
+    @contextmanager
+    def acquire(self):
+        session = self.idle.get()
+
+        try:
+            if session is None or not session.alive():
+                with self.lock:
+                    # forget (and reap) the session that died
+                    if session is not None:
+                        self.sessions.remove(session)
+                        session.close()
+
+                    # only None or a live session goes back to the queue,
+                    # even if starting the new one fails
+                    session = None
+                    session = Session(self.cmd)
+                    self.sessions.append(session)
+
+            yield session
+        finally:
+            self.idle.put(session)
+
+
+    def run(self, txt, payloads=()):
+        """
+        Execute script `txt` on an idle session. Sessions are shared by
+        unrelated scripts, so they are reset before every one.
+        """
+        with self.acquire() as session:
+            return session.run(txt, payloads, clean=True)
+
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions:
+                session.close()
+
+            self.sessions = []
+
+
+class Fifo(object):
+    """
+    Named pipe gnuplot can read data from as if it were a regular file.
+    The buffers of the data are written by a background thread, nothing
+    touches the disk.
+    """
+    __slots__ = ("path", "thread")
+
+    def __init__(self, path, bufs):
+        os.mkfifo(path)
+
+        self.path = path
+        self.thread = Thread(target=self.feed, args=(bufs,))
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def feed(self, bufs):
+        try:
+            with open(self.path, "wb") as f:
+                for buf in bufs:
+                    f.write(buf)
+        except BrokenPipeError:
+            pass
+
+
+    def close(self):
+        # gnuplot did not (fully) read the data, open and close the
+        # reading end until the writer is released
+        while self.thread.is_alive():
+            os.close(os.open(self.path, os.O_RDONLY | os.O_NONBLOCK))
+            self.thread.join(0.01)
+
+        os.remove(self.path)
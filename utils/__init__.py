@@ -1,9 +1,47 @@
-from utils.base import *
-from utils.path import *
-from utils.enforce import *
-from utils.cli import *
-from utils.cmd import *
-from utils.ninja import *
-from utils.project import *
-from utils.simpledoc import *
-from utils.html import *
+from importlib import import_module as _import_module
+
+# Submodules are imported on first access of one of their names, so
+# scripts only pay for the parts of the package they actually use.
+_submodules = (
+    "base", "path", "enforce", "cli", "cmd", "ninja", "project",
+    "simpledoc", "html",
+)
+
+# names exported by "from utils import *", resolved by __getattr__
+__all__ = (
+    # base
+    "Seq", "flat", "new_type", "str_t", "isiter", "all_same",
+    "make_object", "cat", "compose", "fs", "load", "Enum", "namespace",
+    "export", "JSONSave", "separate_options",
+    # path
+    "cd", "Path",
+    # enforce
+    "enforce", "type_enforce",
+    # cli
+    "annot", "ArgParse", "pos", "opt", "flag",
+    # cmd
+    "Command", "subcommands",
+    # ninja
+    "Ninja",
+    # project
+    "ProjectMixin", "Git", "Project", "SourceLister", "Go",
+    # simpledoc
+    "SimpleDoc",
+    # html
+    "Encoder", "url_regex", "ImagePaths", "HTML", "Library", "tags", "t",
+    "stags", "st", "Children", "Options", "url", "doi", "collapsable",
+    "Doc", "js", "plotly", "Plotly", "css",
+)
+
+
+def __getattr__(name):
+    if not name.startswith("__"):
+        for submodule in _submodules:
+            mod = _import_module("utils.%s" % submodule)
+
+            if name in getattr(mod, "__all__", vars(mod)):
+                value = getattr(mod, name)
+                globals()[name] = value
+                return value
+
+    raise AttributeError("module 'utils' has no attribute '%s'" % name)
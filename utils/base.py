@@ -1,6 +1,8 @@
 import sys
 import functools as ft
 import json
+from keyword import iskeyword
+from collections import OrderedDict
 
 __all__ = (
     "Seq", "flat", "new_type", "str_t", "isiter", "all_same",
@@ -1,5 +1,4 @@
 import re
-import requests
 import os.path as path
 from base64 import b64encode
 
@@ -72,6 +71,9 @@ class Encoder(object):
             raise TypeError("Given path ('%s') to encodable media is "
                 "not a valid URL or valid filepath!" % media_path)
         
+        # only needed for remote media, it is slow to import
+        import requests
+        
         response = requests.get(media_path)
         response.raise_for_status()
         